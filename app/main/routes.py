@@ -1,27 +1,37 @@
 from app.main import bp
-from flask import Flask, render_template, request, flash, redirect, url_for
-import disassembler
+from flask import Flask, Response, current_app, render_template, request, flash, redirect, url_for, stream_with_context
 import glob
+import os
 import vm
 import sys
 
+OBJ_DIR = "./obj"
+
+_obj_list_cache = {"mtime": None, "obj_list": []}
 
-@bp.route('/', methods=['GET','POST'])
-def index():
-    obj_list = glob.glob("./obj/*.obj")
 
+def list_obj_files():
+    '''Returns the .obj files in OBJ_DIR, globbing again only when the directory's mtime changes'''
+    mtime = os.stat(OBJ_DIR).st_mtime
+    if mtime != _obj_list_cache["mtime"]:
+        _obj_list_cache["obj_list"] = glob.glob(OBJ_DIR + "/*.obj")
+        _obj_list_cache["mtime"] = mtime
+    return _obj_list_cache["obj_list"]
 
-    h = disassembler.read_file("./obj/hello.obj")
 
-    for index,inst in enumerate(h):
-        pc = index + 1 + 3000
-        print(disassembler.single_ins(pc, inst))
+@bp.route('/', methods=['GET','POST'])
+def index():
+    return render_template("main_page.html", obj_list=list_obj_files())
 
-    return render_template("main_page.html", obj_list=obj_list)
+def stream_template(template_name, **context):
+    '''Like render_template, but renders lazily so generators in the context are consumed as the page is sent'''
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(50)
+    return stream
 
 @bp.route('/view_disassembled/<path:path>', methods=['GET','POST'])
 def view_disassembled(path):
-    vm_gen = vm.main_generator(args=[sys.argv[0], path])
-    commands = [c for c in vm_gen]
+    vm_gen = vm.main_generator(args=[sys.argv[0], path], batch_size=request.args.get('batch', 1, type=int))
 
-    return render_template("disassembler.html", commands=commands)
\ No newline at end of file
+    return Response(stream_with_context(stream_template("disassembler.html", commands=vm_gen)))
\ No newline at end of file
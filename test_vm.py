@@ -0,0 +1,191 @@
+'''
+Checks that the compiled core (run_block) and the python ops (used by main_generator) execute
+instructions identically, and that both main loops run whole programs correctly.
+
+Run with: python -m unittest test_vm
+'''
+
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import vm
+
+# Opcodes both interpreters execute without handing over to python: everything but RTI, RES and TRAP
+PLAIN_OPCODES = [op for op in range(16) if op not in (vm.OP.RTI, vm.OP.RES, vm.OP.TRAP)]
+
+
+def python_step():
+    '''Executes the instruction at the PC with the python ops, through the decoded[] cache as main_generator does'''
+    pc = vm.reg[vm.PC]
+    entry = vm.decoded[pc]
+    if entry is None:
+        entry = vm.decoded[pc] = vm.decode(int(vm.memory[pc]))
+    fun, r0, r1, operand, _ = entry
+    vm.reg[vm.PC] += 1
+    fun(r0, r1, operand)
+
+
+def write_image(words, origin=vm.PC_START):
+    '''Writes words as a big-endian LC-3 object file and returns its path'''
+    fd, path = tempfile.mkstemp(suffix='.obj')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(np.array([origin] + words, dtype='>u2').tobytes())
+    return path
+
+
+class RunBlockMatchesPythonOps(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_memory = vm.memory
+        self.errstate = np.errstate(over='ignore')
+        self.errstate.__enter__()
+
+    def tearDown(self):
+        self.errstate.__exit__(None, None, None)
+        vm.memory = self.saved_memory
+        vm.mem_writes.clear()
+
+    def assert_same_steps(self, memory, regs, steps):
+        '''Runs both interpreters one instruction at a time from the same state, comparing after every step'''
+        jit_memory, jit_reg = memory.copy(), regs.copy()
+        vm.memory = memory.copy()
+        vm.reg[:] = regs
+        vm.decoded[:] = [None] * vm.UINT16_MAX
+        for step in range(steps):
+            instr = int(jit_memory[jit_reg[vm.PC]])
+            _, stop_reason, _ = vm.run_block(jit_memory, jit_reg, 1)
+            if stop_reason != vm.STOP_STEPS:
+                break
+            python_step()
+            vm.mem_writes.clear()
+            context = f'step {step}, instruction {instr:#06x}'
+            np.testing.assert_array_equal(jit_reg, vm.reg, err_msg=context)
+            np.testing.assert_array_equal(jit_memory, vm.memory, err_msg=context)
+
+    def test_jsrr_r7(self):
+        memory = np.zeros(vm.UINT16_MAX, dtype=np.uint16)
+        memory[vm.PC_START] = 0x41C0  # JSRR R7
+        regs = np.zeros(vm.R.COUNT, dtype=np.uint16)
+        regs[vm.PC] = vm.PC_START
+        regs[vm.R7] = 0x4000
+        self.assert_same_steps(memory, regs, 1)
+        self.assertEqual(vm.reg[vm.PC], 0x4000)
+        self.assertEqual(vm.reg[vm.R7], vm.PC_START + 1)
+
+    def test_random_programs(self):
+        rng = np.random.default_rng(0)
+        for _ in range(300):
+            # every word is a plain instruction, so execution can wander through all of memory
+            opcodes = rng.choice(PLAIN_OPCODES, vm.UINT16_MAX).astype(np.uint16)
+            words = opcodes << 12 | rng.integers(0, 1 << 12, vm.UINT16_MAX, dtype=np.uint16)
+            regs = rng.integers(0, 1 << 16, vm.R.COUNT, dtype=np.uint16)
+            regs[vm.COND] = vm.FL.ZRO
+            self.assert_same_steps(words, regs, 200)
+
+
+# Runs the ADD at TARGET, stores a different ADD over it and runs it again, then prints '0' + R0
+SELF_MODIFYING_PROGRAM = [
+    0x5020,  # AND R0, R0, #0
+    0x54A0,  # AND R2, R2, #0
+    0x1021,  # TARGET ADD R0, R0, #1
+    0x14A1,  # ADD R2, R2, #1
+    0x2207,  # LD R1, PATCH
+    0x33FC,  # ST R1, TARGET
+    0x16BE,  # ADD R3, R2, #-2
+    0x09FA,  # BRn TARGET
+    0x2204,  # LD R1, ASCII_0
+    0x1001,  # ADD R0, R0, R1
+    0xF021,  # OUT
+    0xF025,  # HALT
+    0x1027,  # PATCH ADD R0, R0, #7
+    0x0030,  # ASCII_0 .FILL x30
+]
+
+
+class SelfModifyingCode(unittest.TestCase):
+
+    def setUp(self):
+        self.path = write_image(SELF_MODIFYING_PROGRAM)
+
+    def tearDown(self):
+        os.remove(self.path)
+        vm.mem_writes.clear()
+
+    def test_main_generator_redecodes_stored_instruction(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            steps = list(itertools.islice(vm.main_generator(['vm.py', self.path]), 1000))
+        # a stale decoded[] entry would add 1 twice and print '2'
+        self.assertEqual(''.join(step.get('output_buffer', '') for step in steps), '8')
+        self.assertEqual(vm.memory[vm.PC_START + 2], 0x1027)
+        self.assertEqual([vm.reg[r] for r in (vm.R0, vm.R1, vm.R2, vm.R3)], [ord('8'), ord('0'), 2, 0])
+        self.assertEqual(vm.reg[vm.PC], vm.PC_START + 12)
+
+
+# Waits for a key through KBSR, whose address is built at runtime rather than stored in the image, then echoes it
+KBSR_POLL_PROGRAM = [
+    0x2206,  # LD R1, MASK
+    0x927F,  # NOT R1, R1          ; R1 = xFE00, KBSR
+    0x6040,  # LDR R0, R1, #0
+    0x07FE,  # BRzp #-2            ; until KBSR bit 15 is set
+    0x6042,  # LDR R0, R1, #2      ; KBDR
+    0xF021,  # OUT
+    0xF025,  # HALT
+    0x01FF,  # MASK .FILL x01FF
+]
+
+
+class KeyboardRegisters(unittest.TestCase):
+
+    def setUp(self):
+        self.path = write_image(KBSR_POLL_PROGRAM)
+        vm.key_buffer.clear()
+        vm.key_buffer.append(ord('a'))
+
+    def tearDown(self):
+        os.remove(self.path)
+        vm.key_buffer.clear()
+        vm.mem_writes.clear()
+
+    def test_run_block_stops_on_kbsr_load(self):
+        vm.read_image_file(self.path)
+        regs = np.zeros(vm.R.COUNT, dtype=np.uint16)
+        regs[vm.PC] = vm.PC_START
+        with np.errstate(over='ignore'):
+            pc, stop_reason, _ = vm.run_block(vm.memory, regs, vm.BLOCK_STEPS)
+        self.assertEqual((pc, stop_reason), (vm.PC_START + 2, vm.STOP_KEYBOARD))
+        self.assertEqual(regs[vm.PC], vm.PC_START + 2)
+
+    def test_main(self):
+        vm.is_running = 1
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            vm.main(['vm.py', self.path])
+        self.assertEqual(out.getvalue(), 'aHALT\n')
+        self.assertFalse(vm.key_buffer)
+
+    def test_main_generator(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator = vm.main_generator(['vm.py', self.path])
+            steps = [next(generator)]
+            replayed = vm.get_memory_snapshot()
+            # bounded, so a poll that never sees the key fails instead of spinning forever
+            steps += itertools.islice(generator, 1000)
+        self.assertEqual(''.join(step.get('output_buffer', '') for step in steps), 'a')
+        self.assertEqual(vm.reg[vm.R0], ord('a'))
+        self.assertFalse(vm.key_buffer)
+        # the keyboard register updates show up in mem_delta like any store
+        for step in steps:
+            for address, old, new in step['mem_delta']:
+                self.assertEqual(replayed[address], old)
+                replayed[address] = new
+        np.testing.assert_array_equal(replayed, vm.memory)
+
+
+if __name__ == '__main__':
+    unittest.main()
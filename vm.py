@@ -14,26 +14,32 @@ License: MIT
 
 __version__ = '1.1'
 
-import array
+import atexit
+import numpy as np
+import os
 import select
 import sys
 import termios
 import tty
-import getch
-from functools import wraps
+from collections import deque
 
-def instruction_decorator(func):
-    @wraps(func)
-    def function_wrapper(*args, **kwargs):
-        #print(f"Before calling {func.__name__} with arguments {args}")
-        func(*args, **kwargs)
-    return function_wrapper
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it run_block runs as plain python, with the same results, only slower
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 UINT16_MAX = 2 ** 16
 PC_START = 0x3000
+# Instructions run_block executes per call
+BLOCK_STEPS = 1000
 
 is_running = 1
 memory = None
+# (address, old value, new value) of the stores made since main_generator last yielded, including the
+# keyboard register updates made by mem_read
+mem_writes = []
 
 class vsys:
     command_buffer = ""
@@ -41,15 +47,15 @@ class vsys:
     def stdin():
         return sys.stdin
     class stdout:
-        output_buffer = ""
+        output_buffer = []
         @staticmethod
         def flush():
             sys.stdout.flush()
-            #vsys.stdout.output_buffer = ""
+            #vsys.stdout.output_buffer.clear()
         @staticmethod
         def write(c):
             sys.stdout.write(c)
-            vsys.stdout.output_buffer += c
+            vsys.stdout.output_buffer.append(c)
         @staticmethod
         def read(n):
             sys.stdout.read(n)
@@ -77,15 +83,22 @@ class R:
     COUNT   = 10
 
 
-class register_dict(dict):
-    '''Creates a dictionary that can only have values between 0 and UINT16_MAX
-    This is used to represent registers'''
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value % UINT16_MAX)
+# The registers as plain module level ints. Hot paths then do a single global load instead of a global load
+# plus an attribute lookup, and numba's nopython mode can read them.
+R0 = R.R0
+R1 = R.R1
+R2 = R.R2
+R3 = R.R3
+R4 = R.R4
+R5 = R.R5
+R6 = R.R6
+R7 = R.R7
+PC = R.PC
+COND = R.COND
 
 
-#Initializes registers to 0's
-reg = register_dict({i: 0 for i in range(R.COUNT)})
+#Initializes registers to 0's. uint16 registers wrap around on overflow, like the hardware's.
+reg = np.zeros(R.COUNT, dtype=np.uint16)
 
 class OP:
     """opcodes.
@@ -133,126 +146,81 @@ OPs implementaion
 """
 
 
-def bad_opcode(op):
+# Every op takes the same three operands, which decode() extracts once per instruction word:
+# the DR field (bits 11-9), the SR1/BaseR field (bits 8-6), and a third operand that depends on
+# the op (see OPERAND_TABLE). Fields an op does not use are still passed, and ignored.
+
+def bad_opcode(r0, r1, op):
     raise Exception(f'Bad opcode: {op}')
 
-@instruction_decorator
-def add(instr):
-    # destination register (DR)
-    r0 = (instr >> 9) & 0x7
-    # first operand (SR1)
-    r1 = (instr >> 6) & 0x7
-    # whether we are in immediate mode
-    imm_flag = (instr >> 5) & 0x1
-
-    if imm_flag:
-        imm5 = sign_extend(instr & 0x1F, 5)
-        reg[r0] = reg[r1] + imm5
-    else:
-        r2 = instr & 0x7
-        reg[r0] = reg[r1] + reg[r2]
+def add_reg(r0, r1, r2):
+    # r0: destination register (DR), r1: first operand (SR1), r2: second operand (SR2)
+    reg[r0] = reg[r1] + reg[r2]
+    update_flags(r0)
 
+def add_imm(r0, r1, imm5):
+    reg[r0] = reg[r1] + imm5
     update_flags(r0)
 
-@instruction_decorator
-def ldi(instr):
+def ldi(r0, r1, pc_offset):
     """Load indirect"""
-    # destination register (DR)
-    r0 = (instr >> 9) & 0x7
-    # PCoffset 9
-    pc_offset = sign_extend(instr & 0x1ff, 9)
     # add pc_offset to the current PC, look at that memory location to get
     # the final address
-    reg[r0] = mem_read(mem_read(reg[R.PC] + pc_offset))
+    reg[r0] = mem_read(mem_read(reg[PC] + pc_offset))
     update_flags(r0)
 
-@instruction_decorator
-def and_(instr):
-    r0 = (instr >> 9) & 0x7
-    r1 = (instr >> 6) & 0x7
-    r2 = instr & 0x7
-    imm_flag = (instr >> 5) & 0x1
-
-    if imm_flag:
-        imm5 = sign_extend(instr & 0x1F, 5)
-        reg[r0] = reg[r1] & imm5
-    else:
-        reg[r0] = reg[r1] & reg[r2]
+def and_reg(r0, r1, r2):
+    reg[r0] = reg[r1] & reg[r2]
+    update_flags(r0)
 
+def and_imm(r0, r1, imm5):
+    reg[r0] = reg[r1] & imm5
     update_flags(r0)
 
-@instruction_decorator
-def not_(instr):
-    r0 = (instr >> 9) & 0x7
-    r1 = (instr >> 6) & 0x7
+def not_(r0, r1, unused):
     reg[r0] = ~reg[r1]
     update_flags(r0)
 
-@instruction_decorator
-def br(instr):
-    pc_offset = sign_extend((instr) & 0x1ff, 9)
-    cond_flag = (instr >> 9) & 0x7
-    if cond_flag & reg[R.COND]:
-        reg[R.PC] += pc_offset
-
-@instruction_decorator
-def jmp(instr):
-    r1 = (instr >> 6) & 0x7
-    reg[R.PC] = reg[r1]
+def br(cond_flag, r1, pc_offset):
+    if cond_flag & reg[COND]:
+        reg[PC] += pc_offset
+
+def jmp(r0, r1, unused):
+    reg[PC] = reg[r1]
     vsys.command_buffer = f"JMP {r1} ; Move the PC"
 
-@instruction_decorator
-def jsr(instr):
-    r1 = (instr >> 6) & 0x7
-    long_pc_offset = sign_extend(instr & 0x7ff, 11)
-    long_flag = (instr >> 11) & 1
-    reg[R.R7] = reg[R.PC]
+def jsr(r0, r1, long_pc_offset):
+    # bit 11, the top bit of the DR field, selects JSR over JSRR
+    long_flag = r0 >> 2
+    # read BaseR before R7 is overwritten, so JSRR R7 jumps to the old R7
+    target = reg[r1]
+    reg[R7] = reg[PC]
 
     if long_flag:
-        reg[R.PC] += long_pc_offset  # JSR
+        reg[PC] += long_pc_offset  # JSR
     else:
-        reg[R.PC] = reg[r1]
+        reg[PC] = target
 
-@instruction_decorator
-def ld(instr):
-    r0 = (instr >> 9) & 0x7
-    pc_offset = sign_extend(instr & 0x1ff, 9)
-    reg[r0] = mem_read(reg[R.PC] + pc_offset)
+def ld(r0, r1, pc_offset):
+    reg[r0] = mem_read(reg[PC] + pc_offset)
     update_flags(r0)
 
-@instruction_decorator
-def ldr(instr):
-    r0 = (instr >> 9) & 0x7
-    r1 = (instr >> 6) & 0x7
-    offset = sign_extend(instr & 0x3F, 6)
+def ldr(r0, r1, offset):
     reg[r0] = mem_read(reg[r1] + offset)
     update_flags(r0)
 
-@instruction_decorator
-def lea(instr):
-    r0 = (instr >> 9) & 0x7
-    pc_offset = sign_extend(instr & 0x1ff, 9)
-    reg[r0] = reg[R.PC] + pc_offset
+def lea(r0, r1, pc_offset):
+    reg[r0] = reg[PC] + pc_offset
     update_flags(r0)
     vsys.command_buffer = f"LEA {r0} {reg[r0]} ; Load Effective Address"
 
-@instruction_decorator
-def st(instr):
-    r0 = (instr >> 9) & 0x7
-    pc_offset = sign_extend(instr & 0x1ff, 9)
-    mem_write(reg[R.PC] + pc_offset, reg[r0])
-
-@instruction_decorator
-def sti(instr):
-    r0 = (instr >> 9) & 0x7
-    pc_offset = sign_extend(instr & 0x1ff, 9)
-    mem_write(mem_read(reg[R.PC] + pc_offset), reg[r0])
-
-@instruction_decorator
-def str_(instr):
-    r0 = (instr >> 9) & 0x7
-    r1 = (instr >> 6) & 0x7
-    offset = sign_extend(instr & 0x3F, 6)
+def st(r0, r1, pc_offset):
+    mem_write(reg[PC] + pc_offset, reg[r0])
+
+def sti(r0, r1, pc_offset):
+    mem_write(mem_read(reg[PC] + pc_offset), reg[r0])
+
+def str_(r0, r1, offset):
     mem_write(reg[r1] + offset, reg[r0])
 
 
@@ -270,12 +238,15 @@ class Trap:
     HALT = 0x25  # halt the program
 
 
-def trap(instr):
-    traps.get(instr & 0xFF)()
+def trap(r0, r1, trap_vect8):
+    vector = trap_vect8 - Trap.GETC
+    if not 0 <= vector < len(TRAP_TABLE):
+        raise Exception(f'Bad trap: {trap_vect8}')
+    TRAP_TABLE[vector]()
 
 
 def trap_putc():
-    i = reg[R.R0]
+    i = reg[R0]
     c = memory[i]
     while c != 0:
         vsys.stdout.write(c)
@@ -284,45 +255,47 @@ def trap_putc():
 
 
 def trap_getc():
-    reg[R.R0] = ord(getch.getch())
+    reg[R0] = getc()
 
 
 def trap_out():
-    vsys.stdout.write(chr(reg[R.R0]))
+    c = chr(reg[R0])
+    vsys.stdout.write(c)
     vsys.stdout.flush()
-    vsys.command_buffer = f"OUT ({vsys.stdout.output_buffer}) ; output a character"
+    vsys.command_buffer = f"OUT ({c}) ; output a character"
 
 
 def trap_in():
     vsys.stdout.write("Enter a character: ")
     vsys.stdout.flush()
     vsys.command_buffer = "IN"
-    reg[R.R0] = vsys.stdout.read(1)
-
-
-def trap_puts():
-    for i in range(reg[R.R0], len(memory)):
-        c = memory[i]
-        if c == 0:
-            break
-        vsys.stdout.write(chr(c))
-    vsys.command_buffer = f"PUTS ; output a byte string ({vsys.stdout.output_buffer})"
+    reg[R0] = getc()
+    vsys.stdout.write(chr(reg[R0]))
     vsys.stdout.flush()
 
 
+def string_at(address):
+    """Returns the little-endian bytes of the words from address up to, but not including, the first zero word"""
+    words = memory[address:]
+    end = np.argmax(words == 0)  # argmax stops at the first True
+    if words[end]:
+        end = len(words)
+    return words[:end].astype('<u2').tobytes()
 
 
+def trap_puts():
+    # one character per word, in the low byte
+    s = string_at(reg[R0])[::2].decode('latin-1')
+    vsys.stdout.write(s)
+    vsys.command_buffer = f"PUTS ; output a byte string ({s})"
+    vsys.stdout.flush()
+
 
 def trap_putsp():
-    for i in range(reg[R.R0], len(memory)):
-        c = memory[i]
-        if c == 0:
-            break
-        vsys.stdout.write(chr(c & 0xFF))
-        char = c >> 8
-        if char:
-            vsys.stdout.write(chr(char))
-    vsys.command_buffer = f"PUTS ; ({vsys.stdout.output_buffer})"
+    # two characters per word, low byte first; a zero high byte pads an odd length string
+    s = string_at(reg[R0]).replace(b'\0', b'').decode('latin-1')
+    vsys.stdout.write(s)
+    vsys.command_buffer = f"PUTS ; ({s})"
     vsys.stdout.flush()
 
 
@@ -333,33 +306,37 @@ def trap_halt():
     is_running = 0
 
 
-traps = {
-    Trap.GETC: trap_getc,
-    Trap.OUT: trap_out,
-    Trap.PUTS: trap_puts,
-    Trap.IN: trap_in,
-    Trap.PUTSP: trap_putsp,
-    Trap.HALT: trap_halt,
-}
-
-
-ops = {
-    OP.ADD: add,
-    OP.NOT: not_,
-    OP.AND: and_,
-    OP.BR: br,
-    OP.JMP: jmp,
-    OP.RET: jmp,
-    OP.JSR: jsr,
-    OP.LD: ld,
-    OP.LDI: ldi,
-    OP.LDR: ldr,
-    OP.LEA: lea,
-    OP.ST: st,
-    OP.STI: sti,
-    OP.STR: str_,
-    OP.TRAP: trap,
-}
+# Indexed by trap vector - Trap.GETC
+TRAP_TABLE = (
+    trap_getc,
+    trap_out,
+    trap_puts,
+    trap_in,
+    trap_putsp,
+    trap_halt,
+)
+
+
+# Indexed by (opcode << 1) | imm_flag, i.e. ((instr >> 11) & 0x1E) | ((instr >> 5) & 1).
+# ADD and AND pick their register or immediate variant here; every other opcode fills both slots.
+DISPATCH32 = (
+    br, br,                     # OP.BR
+    add_reg, add_imm,           # OP.ADD
+    ld, ld,                     # OP.LD
+    st, st,                     # OP.ST
+    jsr, jsr,                   # OP.JSR
+    and_reg, and_imm,           # OP.AND
+    ldr, ldr,                   # OP.LDR
+    str_, str_,                 # OP.STR
+    bad_opcode, bad_opcode,     # OP.RTI
+    not_, not_,                 # OP.NOT
+    ldi, ldi,                   # OP.LDI
+    sti, sti,                   # OP.STI
+    jmp, jmp,                   # OP.JMP, OP.RET
+    bad_opcode, bad_opcode,     # OP.RES
+    lea, lea,                   # OP.LEA
+    trap, trap,                 # OP.TRAP
+)
 
 
 class Mr:
@@ -367,27 +344,76 @@ class Mr:
     KBDR = 0xFE02  # keyboard data
 
 
+KBSR = Mr.KBSR
+KBDR = Mr.KBDR
+
+
+# Keys read from stdin but not yet consumed by the program
+key_buffer = deque()
+terminal_ready = False
+
+
+def setup_terminal():
+    '''Switches the terminal to cbreak mode once for the whole process, instead of once per key,
+    and restores it at exit. cbreak rather than raw keeps Ctrl-C working.'''
+    global terminal_ready
+    if terminal_ready or not vsys.stdin().isatty():
+        return
+    fd = vsys.stdin().fileno()
+    atexit.register(termios.tcsetattr, fd, termios.TCSADRAIN, termios.tcgetattr(fd))
+    tty.setcbreak(fd)
+    terminal_ready = True
+
+
+def getc():
+    '''Returns the next key, blocking until there is one'''
+    while not key_buffer:
+        keys = os.read(vsys.stdin().fileno(), 64)
+        if not keys:
+            raise EOFError('stdin closed')
+        key_buffer.extend(keys)
+    return key_buffer.popleft()
+
+
 def check_key():
-    _, o, _ = select.select([], [vsys.stdin()], [], 0)
-    for s in o:
+    if key_buffer:
+        return True
+    # Polled on every run, so only a key actually waiting on a terminal may reach getc.
+    if not vsys.stdin().isatty():
+        return False
+    i, _, _ = select.select([vsys.stdin()], [], [], 0)
+    for s in i:
         if s == vsys.stdin():
             return True
     return False
 
 
 def mem_write(address, val):
-    address = address % UINT16_MAX
+    address &= 0xFFFF
+    mem_writes.append((int(address), int(memory[address]), int(val)))
     memory[address] = val
+    decoded[address] = None
+
+
+def get_memory_snapshot():
+    '''Returns a copy of memory as it is now.
+    main_generator only yields the changes each step makes, so take a snapshot when a full view is needed.'''
+    return memory.copy()
 
 
 def mem_read(address):
-    address = address % UINT16_MAX
-    if address == Mr.KBSR:
+    address &= 0xFFFF
+    if address == KBSR:
+        # keys are only taken off the buffer when the program asks for one, so GETC and IN keep their type-ahead
+        # these updates go through mem_write, so main_generator's mem_delta sees them too
         if check_key():
-            memory[Mr.KBSR] = 1 << 15
-            memory[Mr.KBDR] = ord(getch.getch())
-        else:
-            memory[Mr.KBSR] = 0
+            mem_write(KBSR, 1 << 15)
+            mem_write(KBDR, getc())
+        elif memory[KBSR]:
+            mem_write(KBSR, 0)
+    elif address == KBDR and memory[KBSR]:
+        # reading the key data consumes the key
+        mem_write(KBSR, 0)
     return memory[address]
 
 
@@ -397,25 +423,205 @@ def sign_extend(x, bit_count):
     return x & 0xffff
 
 
+# sign_extend precomputed for every value of the 5, 6, 9 and 11 bit immediate fields
+SEXT5 = tuple(sign_extend(x, 5) for x in range(1 << 5))
+SEXT6 = tuple(sign_extend(x, 6) for x in range(1 << 6))
+SEXT9 = tuple(sign_extend(x, 9) for x in range(1 << 9))
+SEXT11 = tuple(sign_extend(x, 11) for x in range(1 << 11))
+
+
+# The third operand of each DISPATCH32 handler, as (mask, table): operand = table[instr & mask]
+_NO_OPERAND = (0, (0,))
+_SR2 = (0x7, range(1 << 3))
+_IMM5 = (0x1F, SEXT5)
+_OFFSET6 = (0x3F, SEXT6)
+_PCOFFSET9 = (0x1FF, SEXT9)
+_PCOFFSET11 = (0x7FF, SEXT11)
+_TRAPVECT8 = (0xFF, range(1 << 8))
+_INSTR = (0xFFFF, range(1 << 16))
+
+OPERAND_TABLE = (
+    _PCOFFSET9, _PCOFFSET9,     # OP.BR
+    _SR2, _IMM5,                # OP.ADD
+    _PCOFFSET9, _PCOFFSET9,     # OP.LD
+    _PCOFFSET9, _PCOFFSET9,     # OP.ST
+    _PCOFFSET11, _PCOFFSET11,   # OP.JSR
+    _SR2, _IMM5,                # OP.AND
+    _OFFSET6, _OFFSET6,         # OP.LDR
+    _OFFSET6, _OFFSET6,         # OP.STR
+    _INSTR, _INSTR,             # OP.RTI
+    _NO_OPERAND, _NO_OPERAND,   # OP.NOT
+    _PCOFFSET9, _PCOFFSET9,     # OP.LDI
+    _PCOFFSET9, _PCOFFSET9,     # OP.STI
+    _NO_OPERAND, _NO_OPERAND,   # OP.JMP, OP.RET
+    _INSTR, _INSTR,             # OP.RES
+    _PCOFFSET9, _PCOFFSET9,     # OP.LEA
+    _TRAPVECT8, _TRAPVECT8,     # OP.TRAP
+)
+
+
+def decode(instr):
+    '''Decodes an instruction word once into (handler, DR, SR1, third operand, opcode).
+    Executing it is then handler(DR, SR1, third operand).'''
+    index = ((instr >> 11) & 0x1E) | ((instr >> 5) & 1)
+    mask, operands = OPERAND_TABLE[index]
+    return DISPATCH32[index], (instr >> 9) & 0x7, (instr >> 6) & 0x7, operands[instr & mask], instr >> 12
+
+
+# Pre-decoded form of every memory word, filled by read_image_file. None marks a word to decode on
+# its first execution, e.g. outside the loaded image or after a store overwrote it.
+decoded = [None] * UINT16_MAX
+
+
+# Condition flag for every possible register value
+FLAG_TABLE = bytes(FL.ZRO if v == 0 else FL.NEG if v >> 15 else FL.POS for v in range(UINT16_MAX))
+
+
 def update_flags(r):
-    if not reg.get(r):
-        reg[R.COND] = FL.ZRO
-    elif reg[r] >> 15:
-        reg[R.COND] = FL.NEG
-    else:
-        reg[R.COND] = FL.POS
+    reg[COND] = FLAG_TABLE[reg[r]]
+
+
+"""
+JIT compiled core
+"""
+
+# Reasons for run_block to hand control back to python.
+STOP_STEPS = 0  # max_steps instructions were executed
+STOP_TRAP = 1  # the next instruction is a TRAP
+STOP_BAD_OPCODE = 2  # the next instruction is RTI or RES
+STOP_KEYBOARD = 3  # the next instruction loads from KBSR, which polls the keyboard
+
+# Instruction fields, as shifts and masks. Compiled code folds these into immediates.
+OP_SHIFT = 12
+DR_SHIFT = 9  # DR, SR of stores, nzp of BR
+SR1_SHIFT = 6  # SR1, BaseR
+IMM_FLAG_SHIFT = 5
+JSR_FLAG_SHIFT = 11
+REG_MASK = 0x7
+IMM5_MASK = 0x1F
+OFFSET6_MASK = 0x3F
+PCOFFSET9_MASK = 0x1FF
+PCOFFSET11_MASK = 0x7FF
+TRAP_VECT8_MASK = 0xFF
+
+
+@njit(cache=True)
+def _sext(x, bit_count):
+    if (x >> (bit_count - 1)) & 1:
+        x |= 0xFFFF << bit_count
+    return x & 0xFFFF
+
+
+@njit(cache=True)
+def _set_flags(reg, r):
+    # Branchless: FL.POS is 1, a zero value adds 1 for FL.ZRO and the sign bit adds 3 for FL.NEG.
+    v = reg[r]
+    reg[COND] = 1 + (v == 0) + 3 * (v >> 15)
+
+
+@njit(cache=True)
+def run_block(mem, reg, max_steps):
+    '''Executes up to max_steps instructions natively on uint16 memory and register arrays.
+
+    Stops in front of any instruction that needs python (traps, bad opcodes, KBSR loads), leaving the PC pointing at it.
+
+    :return: (pc, stop_reason, trap_code)
+    '''
+    steps = 0
+    while steps < max_steps:
+        pc = reg[PC]
+        instr = int(mem[pc])
+        op = instr >> OP_SHIFT
+        if op == 15:
+            return pc, STOP_TRAP, instr & TRAP_VECT8_MASK
+        if op == 8 or op == 13:
+            return pc, STOP_BAD_OPCODE, 0
+        reg[PC] = pc + 1
+
+        # Decode the fields shared by most opcodes once, up front.
+        dr = (instr >> DR_SHIFT) & REG_MASK
+        sr1 = (instr >> SR1_SHIFT) & REG_MASK
+
+        if op == 1:  # ADD
+            if (instr >> IMM_FLAG_SHIFT) & 1:
+                reg[dr] = reg[sr1] + _sext(instr & IMM5_MASK, 5)
+            else:
+                reg[dr] = reg[sr1] + reg[instr & REG_MASK]
+            _set_flags(reg, dr)
+        elif op == 5:  # AND
+            if (instr >> IMM_FLAG_SHIFT) & 1:
+                reg[dr] = reg[sr1] & _sext(instr & IMM5_MASK, 5)
+            else:
+                reg[dr] = reg[sr1] & reg[instr & REG_MASK]
+            _set_flags(reg, dr)
+        elif op == 9:  # NOT
+            reg[dr] = ~reg[sr1]
+            _set_flags(reg, dr)
+        elif op == 0:  # BR, dr holds the nzp bits
+            if dr & reg[COND]:
+                reg[PC] = reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)
+        elif op == 12:  # JMP, RET
+            reg[PC] = reg[sr1]
+        elif op == 4:  # JSR, JSRR
+            target = reg[sr1]
+            reg[R7] = reg[PC]
+            if (instr >> JSR_FLAG_SHIFT) & 1:
+                reg[PC] = reg[PC] + _sext(instr & PCOFFSET11_MASK, 11)
+            else:
+                reg[PC] = target
+        elif op == 2:  # LD
+            address = (reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)) & 0xFFFF
+            if address == KBSR:
+                reg[PC] = pc
+                return pc, STOP_KEYBOARD, 0
+            reg[dr] = mem[address]
+            if address == KBDR:
+                mem[KBSR] = 0
+            _set_flags(reg, dr)
+        elif op == 10:  # LDI
+            pointer = (reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)) & 0xFFFF
+            address = mem[pointer]
+            if pointer == KBSR or address == KBSR:
+                reg[PC] = pc
+                return pc, STOP_KEYBOARD, 0
+            reg[dr] = mem[address]
+            if address == KBDR:
+                mem[KBSR] = 0
+            _set_flags(reg, dr)
+        elif op == 6:  # LDR
+            address = (reg[sr1] + _sext(instr & OFFSET6_MASK, 6)) & 0xFFFF
+            if address == KBSR:
+                reg[PC] = pc
+                return pc, STOP_KEYBOARD, 0
+            reg[dr] = mem[address]
+            if address == KBDR:
+                mem[KBSR] = 0
+            _set_flags(reg, dr)
+        elif op == 14:  # LEA
+            reg[dr] = reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)
+            _set_flags(reg, dr)
+        elif op == 3:  # ST
+            mem[(reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)) & 0xFFFF] = reg[dr]
+        elif op == 11:  # STI
+            pointer = (reg[PC] + _sext(instr & PCOFFSET9_MASK, 9)) & 0xFFFF
+            mem[mem[pointer]] = reg[dr]
+        elif op == 7:  # STR
+            mem[(reg[sr1] + _sext(instr & OFFSET6_MASK, 6)) & 0xFFFF] = reg[dr]
+        steps += 1
+    return reg[PC], STOP_STEPS, 0
 
 
 def read_image_file(file_name):
     global memory
 
+    memory = np.zeros(UINT16_MAX, dtype=np.uint16)
     with open(file_name, 'rb') as f:
         origin = int.from_bytes(f.read(2), byteorder='big')
-        memory = array.array("H", [0] * origin)
-        max_read = UINT16_MAX - origin
-        memory.frombytes(f.read(max_read))
-        memory.byteswap()
-        memory.fromlist([0]*(UINT16_MAX - len(memory)))
+        # LC-3 object files are big-endian; the conversion to native uint16 is one vectorized pass
+        words = np.frombuffer(f.read(2 * (UINT16_MAX - origin)), dtype='>u2')
+        memory[origin:origin + len(words)] = words
+    decoded[:] = [None] * UINT16_MAX
+    decoded[origin:origin + len(words)] = map(decode, words.tolist())
 
 
 def main(args=sys.argv):
@@ -425,22 +631,66 @@ def main(args=sys.argv):
 
     file_path = args[1]
     read_image_file(file_path)
-
-    reg[R.PC] = PC_START
-
+    setup_terminal()
+
+    reg[PC] = PC_START
+
+    with np.errstate(over='ignore'):
+        while is_running:
+            pc, stop_reason, trap_code = run_block(memory, reg, BLOCK_STEPS)
+            if stop_reason == STOP_STEPS:
+                continue
+            # The compiled core stopped in front of an instruction only python can execute.
+            reg[PC] += 1
+            if stop_reason == STOP_TRAP:
+                trap(0, 0, trap_code)
+            else:
+                fun, r0, r1, operand, _ = decode(int(memory[pc]))
+                fun(r0, r1, operand)
+            # nothing consumes the per-step output and stores here, unlike in main_generator
+            vsys.stdout.output_buffer.clear()
+            mem_writes.clear()
+
+# Opcodes main_generator(yield_on_side_effect=True) always yields after
+SIDE_EFFECT_OPS = frozenset((OP.TRAP, OP.ST, OP.STI, OP.STR))
+
+
+def _run(batch_size, yield_on_side_effect, reg=reg, PC=PC, decoded=decoded, decode=decode,
+         side_effect_ops=SIDE_EFFECT_OPS, mem_writes=mem_writes, vsys=vsys,
+         output_buffer=vsys.stdout.output_buffer):
+    '''The instruction loop of main_generator.
+    What it touches on every step is bound as default arguments, so those are local rather than global lookups.
+    Only objects that are never rebound can be bound this way, so is_running, which trap_halt rebinds, stays global.'''
+    pending = 0
     while is_running:
-        instr = mem_read(reg[R.PC])
-        reg[R.PC] += 1
-        op = instr >> 12
-        fun = ops.get(op, bad_opcode)
-        fun(instr)
+        pc = reg[PC]
+        entry = decoded[pc]                                     # Load the decoded instruction at the PC register,
+        if entry is None:                                       # decoding it now if the word was not decoded yet.
+            entry = decoded[pc] = decode(int(memory[pc]))
+        reg[PC] += 1                                            # Increment the PC register.
+        fun, r0, r1, operand, op = entry
+        fun(r0, r1, operand)                                    # Perform the instruction using its pre-decoded operands.
+        pending += 1
+        if pending < batch_size and is_running and not (yield_on_side_effect and op in side_effect_ops):
+            continue
+        pending = 0
+        yield {"PC":reg[PC], "command":vsys.command_buffer,"op_name":fun.__name__, "op_code":op, "output_buffer":"".join(output_buffer), "memory_id":id(memory), "mem_delta":mem_writes.copy()}
+        mem_writes.clear()
+        output_buffer.clear()
+        vsys.command_buffer= ""
+
 
-def main_generator(args=sys.argv):
+def main_generator(args=sys.argv, batch_size=1, yield_on_side_effect=False):
     '''This is like main, but yields after each instruction, allowing us to use the state of this vm for any
     output visualizer or user interface, e.g. Flask.
 
     :param args: system arguments, but can be executed outside of command line interface
-    :yield: After each instruction yields the program counter
+    :param batch_size: yield only every batch_size instructions, and once the program halts
+    :param yield_on_side_effect: also yield after every TRAP and store, whatever the batch position
+    :yield: After each instruction yields the program counter, the command, its output, the id() of the memory
+        array, and as mem_delta the (address, old value, new value) of each store it made, keyboard register
+        updates included. Applying the deltas in order to a get_memory_snapshot() taken at the first yield
+        reproduces memory at any step.
     '''
     global is_running
     is_running = 1
@@ -450,19 +700,13 @@ def main_generator(args=sys.argv):
 
     file_path = args[1]
     read_image_file(file_path)
+    setup_terminal()
 
-    reg[R.PC] = PC_START
-    yield {"PC":reg[R.PC], "command":".ORIG x3000", "op_name":".ORIG", "memory":memory}
-    while is_running:
-        instr = mem_read(reg[R.PC])                             # Load instruction from PC register
-        reg[R.PC] += 1                                          # Increment the PC register.
-        op = instr >> 12                                        #
-        fun = ops.get(op, bad_opcode)                           # Look at the opcode to determine which type of instruction it should perform.
-        fun(instr)                                              # Perform the instruction using the parameters in the instruction.
-        yield {"PC":reg[R.PC], "command":vsys.command_buffer,"op_name":fun.__name__, "op_code":op, "output_buffer":vsys.stdout.output_buffer, "memory":memory}
-        vsys.stdout.output_buffer = ""
-        vsys.command_buffer= ""
-
+    reg[PC] = PC_START
+    mem_writes.clear()
+    yield {"PC":reg[PC], "command":".ORIG x3000", "op_name":".ORIG", "memory_id":id(memory), "mem_delta":[]}
+    with np.errstate(over='ignore'):
+        yield from _run(batch_size, yield_on_side_effect)
 
 
 if __name__ == '__main__':